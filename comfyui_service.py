@@ -1,13 +1,21 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Response, status
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Response, Request, Header, Query, status
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
 from pydantic import BaseModel, HttpUrl
 import requests
+import asyncio
+import email.message
 import json
 import os
-from typing import Dict, Any, Optional
+import secrets
+from contextlib import asynccontextmanager, nullcontext
+from typing import Callable, Dict, Any, Optional
 from dotenv import load_dotenv
 import logging
 from functools import lru_cache
+import profiling
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -23,6 +31,10 @@ class Settings:
         self.PORT = int(os.getenv("PORT", "8000"))
         self.HOST = os.getenv("HOST", "0.0.0.0")
         self.REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
+        self.PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() in ("1", "true", "yes")
+        self.PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
+        self.SLOW_REQUEST_LOG_SIZE = int(os.getenv("SLOW_REQUEST_LOG_SIZE", "20"))
+        self.PROFILE_MAX_DURATION = int(os.getenv("PROFILE_MAX_DURATION", "60"))
 
 @lru_cache()
 def get_settings():
@@ -30,10 +42,26 @@ def get_settings():
 
 settings = get_settings()
 
+slow_request_log = profiling.SlowRequestLog(settings.SLOW_REQUEST_LOG_SIZE)
+profile_lock = asyncio.Lock()
+# 事件循环延迟检测周期（秒）
+LOOP_LAG_INTERVAL = 0.1
+loop_lag_monitor = profiling.LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """服务启动时按需开启性能分析钩子"""
+    if settings.PROFILING_ENABLED:
+        profiling.install_connect_timer()
+        loop_lag_monitor.start()
+    yield
+    await loop_lag_monitor.stop()
+
 app = FastAPI(
     title="ComfyUI API Service",
     description="腾讯云HAI ComfyUI服务的API封装",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # 配置CORS
@@ -80,9 +108,84 @@ async def health_check():
         )
     return {"status": "healthy", "comfyui_service": "available"}
 
-@app.post("/api/workflow/execute")
+def _phase(timings: Optional[profiling.RequestTimings], name: str):
+    """返回阶段计时上下文，未开启性能分析时为空操作"""
+    if timings is None:
+        return nullcontext()
+    return timings.phase(name)
+
+def _is_json_request(request: Request) -> bool:
+    """与 FastAPI 判断请求体是否按 JSON 解析的规则保持一致
+
+    规则取自 fastapi 0.104.1 fastapi/routing.py 中 get_request_handler 的请求体解析逻辑，
+    升级 FastAPI 时需同步检查（tests/test_api.py 中有对应的一致性测试）。
+    """
+    content_type = request.headers.get("content-type")
+    if not content_type:
+        return True
+    message = email.message.Message()
+    message["content-type"] = content_type
+    if message.get_content_maintype() != "application":
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == "json" or subtype.endswith("+json")
+
+class ProfilingRoute(APIRoute):
+    """开启性能分析时记录请求各阶段耗时的路由
+
+    请求体在这里预先接收（receive）并解析（parse），Starlette 会缓存 request.body() 和
+    request.json() 的结果，FastAPI 直接复用；校验耗时为解析结束到进入接口函数之间的时间，
+    序列化耗时为接口函数返回之后的时间。
+    """
+
+    def get_route_handler(self) -> Callable:
+        original_handler = super().get_route_handler()
+
+        async def handler(request: Request) -> Response:
+            if not settings.PROFILING_ENABLED:
+                return await original_handler(request)
+
+            timings = profiling.RequestTimings(request.url.path)
+            timings.loop_lag = loop_lag_monitor.current_lag()
+            token = profiling.current_timings.set(timings)
+            status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+            try:
+                with timings.phase("receive"):
+                    body = await request.body()
+                with timings.phase("parse"):
+                    if body and _is_json_request(request):
+                        try:
+                            await request.json()
+                        except json.JSONDecodeError:
+                            # 交给 FastAPI 生成标准的 422 错误
+                            pass
+                timings.reset_lap()
+                response = await original_handler(request)
+                timings.lap("serialize")
+                status_code = response.status_code
+                return response
+            except RequestValidationError:
+                status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+                raise
+            except HTTPException as e:
+                status_code = e.status_code
+                raise
+            finally:
+                profiling.current_timings.reset(token)
+                slow_request_log.record(timings.finish(status_code))
+
+        return handler
+
+# 需要分阶段计时的接口注册在该路由上
+profiled_router = APIRouter(route_class=ProfilingRoute)
+
+@profiled_router.post("/api/workflow/execute")
 async def execute_workflow(request: WorkflowRequest):
     """执行工作流"""
+    timings = profiling.current_timings.get()
+    if timings is not None:
+        timings.lap("validate")
+        timings.client_id = request.client_id
     try:
         logger.info(f"Executing workflow with client_id: {request.client_id}")
         url = f"{settings.COMFYUI_BASE_URL}/prompt"
@@ -92,14 +195,22 @@ async def execute_workflow(request: WorkflowRequest):
             "client_id": request.client_id or "default_client"
         }
         
-        response = requests.post(
-            url,
-            json=data,
-            timeout=settings.REQUEST_TIMEOUT
-        )
-        response.raise_for_status()
-        
-        result = response.json()
+        # 请求体单独编码，以便与上游耗时分开统计（与 requests 的 json= 参数编码方式一致）
+        with _phase(timings, "encode"):
+            body = json.dumps(data, allow_nan=False).encode("utf-8")
+
+        with _phase(timings, "upstream"):
+            response = requests.post(
+                url,
+                data=body,
+                headers={"Content-Type": "application/json"},
+                timeout=settings.REQUEST_TIMEOUT
+            )
+            response.raise_for_status()
+
+        with _phase(timings, "decode"):
+            result = response.json()
+
         logger.info(f"Workflow execution successful: {result.get('prompt_id', 'No ID')}")
         return result
     except requests.Timeout:
@@ -114,6 +225,11 @@ async def execute_workflow(request: WorkflowRequest):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"ComfyUI service error: {str(e)}"
         )
+    finally:
+        if timings is not None:
+            timings.reset_lap()
+
+app.include_router(profiled_router)
 
 @app.get("/api/workflow/status/{prompt_id}")
 async def get_workflow_status(prompt_id: str):
@@ -165,6 +281,66 @@ async def get_queue_status():
             detail=f"Failed to get queue status: {str(e)}"
         )
 
+def verify_admin_token(x_admin_token: Optional[str]):
+    """校验性能分析管理接口的访问令牌"""
+    if not settings.PROFILING_ENABLED:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profiling is disabled"
+        )
+    # 按字节比较，非 ASCII 的令牌也不会导致 compare_digest 抛出 TypeError
+    if not settings.PROFILING_ADMIN_TOKEN or not x_admin_token or not secrets.compare_digest(
+        x_admin_token.encode("utf-8"), settings.PROFILING_ADMIN_TOKEN.encode("utf-8")
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid admin token"
+        )
+
+@app.get("/api/admin/profiling/slow-requests")
+async def get_slow_requests(x_admin_token: Optional[str] = Header(None)):
+    """获取耗时最长的请求及其分阶段耗时"""
+    verify_admin_token(x_admin_token)
+    return {
+        "capacity": slow_request_log.capacity,
+        "loop_lag": loop_lag_monitor.stats(),
+        "requests": slow_request_log.snapshot()
+    }
+
+@app.delete("/api/admin/profiling/slow-requests")
+async def clear_slow_requests(x_admin_token: Optional[str] = Header(None)):
+    """清空慢请求记录及事件循环延迟统计"""
+    verify_admin_token(x_admin_token)
+    slow_request_log.clear()
+    loop_lag_monitor.reset()
+    return {"message": "Slow request log cleared"}
+
+@app.post("/api/admin/profiling/profile", response_class=PlainTextResponse)
+async def run_sampling_profile(
+    duration: float = Query(10.0, gt=0),
+    interval_ms: float = Query(10.0, ge=1, le=1000),
+    x_admin_token: Optional[str] = Header(None)
+):
+    """对当前工作进程进行限时采样，返回折叠栈格式（可直接生成火焰图）"""
+    verify_admin_token(x_admin_token)
+    if duration > settings.PROFILE_MAX_DURATION:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Profile duration must not exceed {settings.PROFILE_MAX_DURATION} seconds"
+        )
+    if profile_lock.locked():
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="A profile is already running"
+        )
+    async with profile_lock:
+        logger.info(f"Starting sampling profile for {duration}s at {interval_ms}ms interval")
+        # 采样在独立线程中进行，事件循环可以继续处理请求并被采样到
+        stacks = await asyncio.get_running_loop().run_in_executor(
+            None, profiling.sample_stacks, duration, interval_ms / 1000
+        )
+    return PlainTextResponse(profiling.format_collapsed(stacks))
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(
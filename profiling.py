@@ -0,0 +1,229 @@
+"""
+请求耗时分析与采样性能剖析工具
+
+默认关闭，仅在 PROFILING_ENABLED 打开时由 comfyui_service 使用。
+"""
+import asyncio
+import functools
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Any, List, Optional
+
+# 当前请求的计时器，供上游连接计时钩子读取
+current_timings: ContextVar[Optional["RequestTimings"]] = ContextVar("current_timings", default=None)
+
+class RequestTimings:
+    """单个请求的分阶段计时"""
+
+    __slots__ = ("path", "client_id", "started_at", "start", "phases", "connecting", "loop_lag", "_lap")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.client_id: Optional[str] = None
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self.connecting = False
+        # 请求开始处理前事件循环被阻塞的估计时间，未运行监控时为 None
+        self.loop_lag: Optional[float] = None
+        self._lap = self.start
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def reset_lap(self):
+        self._lap = time.perf_counter()
+
+    def lap(self, name: str):
+        """将上次 reset_lap/lap 到现在的耗时计入 name 阶段"""
+        now = time.perf_counter()
+        self.add(name, now - self._lap)
+        self._lap = now
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def finish(self, status_code: int) -> Dict[str, Any]:
+        """结束计时并生成记录，耗时单位为毫秒"""
+        total = time.perf_counter() - self.start
+        phases = dict(self.phases)
+        # upstream 包含建立连接的时间，拆分为 connect 与 wait 两部分
+        if "upstream" in phases:
+            connect = phases.get("upstream_connect", 0.0)
+            phases["upstream_connect"] = connect
+            phases["upstream_wait"] = max(phases.pop("upstream") - connect, 0.0)
+        return {
+            "path": self.path,
+            "client_id": self.client_id,
+            "status_code": status_code,
+            "started_at": self.started_at,
+            "total_ms": round(total * 1000, 3),
+            "loop_lag_ms": None if self.loop_lag is None else round(self.loop_lag * 1000, 3),
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in phases.items()},
+        }
+
+class SlowRequestLog:
+    """保留耗时最长的 N 个请求记录"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, entry: Dict[str, Any]):
+        if self.capacity <= 0:
+            return
+        item = (entry["total_ms"], next(self._counter), entry)
+        with self._lock:
+            if len(self._heap) < self.capacity:
+                heapq.heappush(self._heap, item)
+            elif item[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = sorted(self._heap, key=lambda item: item[0], reverse=True)
+        return [entry for _, _, entry in items]
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+
+class LoopLagMonitor:
+    """周期性检测事件循环延迟
+
+    后台任务每隔 interval 秒醒来一次，实际醒来时间比预期晚多少即为事件循环被阻塞的时间。
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._last_sample_at: Optional[float] = None
+        self._expected_wake: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self._expected_wake = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._expected_wake = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.last_lag = max(now - self._expected_wake, 0.0)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self._last_sample_at = now
+
+    def current_lag(self) -> Optional[float]:
+        """估计当前时刻之前事件循环被阻塞的时间，须在事件循环中调用
+
+        监控任务尚未醒来时取其超时时长；若它刚在一个周期内醒来，
+        说明阻塞刚刚结束，同时参考它测得的延迟。
+        """
+        if self._expected_wake is None:
+            return None
+        now = asyncio.get_running_loop().time()
+        lag = max(now - self._expected_wake, 0.0)
+        if self._last_sample_at is not None and now - self._last_sample_at <= self.interval:
+            lag = max(lag, self.last_lag)
+        return lag
+
+    def reset(self):
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "interval_ms": round(self.interval * 1000, 3),
+            "last_lag_ms": round(self.last_lag * 1000, 3),
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+        }
+
+def _timed_connect(original):
+    @functools.wraps(original)
+    def connect(self, *args, **kwargs):
+        timings = current_timings.get()
+        # 未开启计时或嵌套调用（如 HTTPS 调用父类 connect）时直接透传
+        if timings is None or timings.connecting:
+            return original(self, *args, **kwargs)
+        timings.connecting = True
+        start = time.perf_counter()
+        try:
+            return original(self, *args, **kwargs)
+        finally:
+            timings.connecting = False
+            timings.add("upstream_connect", time.perf_counter() - start)
+    connect._profiling_wrapped = True
+    return connect
+
+def install_connect_timer():
+    """为 urllib3 连接的 connect 方法加上计时钩子，可重复调用"""
+    from urllib3 import connection
+
+    for cls in (connection.HTTPConnection, connection.HTTPSConnection):
+        original = cls.__dict__.get("connect")
+        if original is None or getattr(original, "_profiling_wrapped", False):
+            continue
+        cls.connect = _timed_connect(original)
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def sample_stacks(duration: float, interval: float) -> Counter:
+    """在 duration 秒内每隔 interval 秒采样一次所有线程的调用栈
+
+    返回 {折叠后的调用栈: 采样次数}，根节点为线程名。
+    """
+    own_ident = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f"thread-{ident}"))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return stacks
+
+def format_collapsed(stacks: Counter) -> str:
+    """输出 flamegraph.pl / speedscope 可直接读取的折叠栈格式"""
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
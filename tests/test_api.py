@@ -2,8 +2,10 @@ import pytest
 from fastapi.testclient import TestClient
 from unittest.mock import patch, MagicMock
 import json
+import time
 import requests
-from comfyui_service import app, Settings
+from starlette.requests import Request
+from comfyui_service import app, Settings, settings, slow_request_log, _is_json_request
 
 client = TestClient(app)
 
@@ -18,6 +20,12 @@ def mock_response():
     mock.json.return_value = {"status": "success"}
     return mock
 
+@pytest.fixture
+def clear_slow_request_log():
+    slow_request_log.clear()
+    yield
+    slow_request_log.clear()
+
 def test_health_check_healthy(mock_settings, mock_response):
     """测试健康检查接口 - 服务正常"""
     with patch('requests.get', return_value=mock_response):
@@ -88,4 +96,144 @@ def test_invalid_workflow_data():
         "invalid_key": "data"
     }
     response = client.post("/api/workflow/execute", json=invalid_workflow)
-    assert response.status_code == 422  # Validation Error 
\ No newline at end of file
+    assert response.status_code == 422  # Validation Error 
+
+def test_execute_workflow_invalid_json():
+    """测试工作流执行 - 请求体不是合法JSON"""
+    response = client.post(
+        "/api/workflow/execute",
+        content="not json",
+        headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 422
+
+def test_execute_workflow_rejects_non_json_content_type(clear_slow_request_log):
+    """测试工作流执行 - 非JSON的Content-Type不会被转发，且开启性能分析不改变错误内容"""
+    payloads = []
+    for profiling_enabled in (False, True):
+        with patch.object(settings, "PROFILING_ENABLED", profiling_enabled), \
+             patch('requests.post') as mock_post:
+            response = client.post(
+                "/api/workflow/execute",
+                content='{"workflow": {}}',
+                headers={"Content-Type": "text/plain"}
+            )
+            assert response.status_code == 422
+            mock_post.assert_not_called()
+            payloads.append(response.json())
+    assert payloads[0] == payloads[1]
+
+@pytest.mark.parametrize("content_type", [
+    None,
+    "application/json",
+    "application/json; charset=utf-8",
+    "application/vnd.api+json",
+    "application/jsonx",
+    "application/x-www-form-urlencoded",
+    "text/json",
+    "text/plain",
+])
+def test_is_json_request_matches_fastapi(content_type, mock_response):
+    """测试 _is_json_request 与 FastAPI 实际的请求体解析规则一致"""
+    headers = {} if content_type is None else {"Content-Type": content_type}
+    with patch.object(settings, "PROFILING_ENABLED", False), \
+         patch('requests.post', return_value=mock_response):
+        response = client.post("/api/workflow/execute", content='{"workflow": {}}', headers=headers)
+    fastapi_parsed_json = response.status_code == 200
+
+    raw_headers = [] if content_type is None else [(b"content-type", content_type.encode("latin-1"))]
+    request = Request({"type": "http", "method": "POST", "headers": raw_headers})
+    assert _is_json_request(request) == fastapi_parsed_json
+
+def test_execute_workflow_openapi_schema():
+    """测试工作流执行接口的OpenAPI文档保持请求模型引用和422响应"""
+    operation = app.openapi()["paths"]["/api/workflow/execute"]["post"]
+    schema = operation["requestBody"]["content"]["application/json"]["schema"]
+    assert schema == {"$ref": "#/components/schemas/WorkflowRequest"}
+    assert "422" in operation["responses"]
+
+def test_execute_workflow_records_slow_request(mock_response, clear_slow_request_log):
+    """测试开启性能分析后记录分阶段耗时"""
+    mock_response.json.return_value = {"prompt_id": "test_id"}
+
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "secret"), \
+         patch('requests.post', return_value=mock_response) as mock_post:
+        response = client.post("/api/workflow/execute", json={"workflow": {"test": "data"}, "client_id": "test_client"})
+        assert response.status_code == 200
+        _, kwargs = mock_post.call_args
+        assert json.loads(kwargs["data"]) == {"prompt": {"test": "data"}, "client_id": "test_client"}
+        assert kwargs["headers"] == {"Content-Type": "application/json"}
+
+        response = client.get("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "secret"})
+        assert response.status_code == 200
+        entry = response.json()["requests"][0]
+        assert entry["client_id"] == "test_client"
+        assert entry["status_code"] == 200
+        assert set(entry["phases_ms"]) == {
+            "receive", "parse", "validate", "encode",
+            "upstream_connect", "upstream_wait", "decode", "serialize"
+        }
+        # 未通过 lifespan 启动事件循环延迟监控时不记录
+        assert entry["loop_lag_ms"] is None
+
+def test_loop_lag_recorded_when_loop_blocked(mock_response, clear_slow_request_log):
+    """测试上游调用阻塞事件循环时能检测到事件循环延迟"""
+    def blocking_post(*args, **kwargs):
+        time.sleep(0.3)
+        return mock_response
+
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "secret"), \
+         patch("profiling.install_connect_timer"), \
+         patch('requests.post', side_effect=blocking_post):
+        with TestClient(app) as lifespan_client:
+            response = lifespan_client.post("/api/workflow/execute", json={"workflow": {"test": "data"}})
+            assert response.status_code == 200
+
+            response = lifespan_client.get("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "secret"})
+            body = response.json()
+            assert body["loop_lag"]["running"]
+            assert body["loop_lag"]["max_lag_ms"] >= 150
+            assert body["requests"][0]["loop_lag_ms"] >= 0
+
+            response = lifespan_client.delete("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "secret"})
+            assert response.status_code == 200
+
+def test_profiling_admin_requires_token():
+    """测试性能分析管理接口 - 未开启或令牌错误"""
+    with patch.object(settings, "PROFILING_ENABLED", False):
+        response = client.get("/api/admin/profiling/slow-requests")
+        assert response.status_code == 404
+
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "secret"):
+        response = client.get("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "wrong"})
+        assert response.status_code == 403
+
+def test_profiling_admin_non_ascii_token():
+    """测试性能分析管理接口 - 非ASCII令牌返回403而不是500"""
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "secret"):
+        response = client.get("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "café".encode("latin-1")})
+        assert response.status_code == 403
+
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "café"):
+        response = client.get("/api/admin/profiling/slow-requests", headers={"X-Admin-Token": "cafe"})
+        assert response.status_code == 403
+
+def test_sampling_profile():
+    """测试采样性能剖析接口返回折叠栈"""
+    with patch.object(settings, "PROFILING_ENABLED", True), \
+         patch.object(settings, "PROFILING_ADMIN_TOKEN", "secret"):
+        response = client.post(
+            "/api/admin/profiling/profile?duration=0.1&interval_ms=5",
+            headers={"X-Admin-Token": "secret"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        line = response.text.splitlines()[0]
+        stack, count = line.rsplit(" ", 1)
+        assert ";" in stack
+        assert int(count) > 0
@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+from urllib3 import connection
+
+from profiling import (
+    LoopLagMonitor, RequestTimings, SlowRequestLog, current_timings, format_collapsed, install_connect_timer
+)
+
+class _OkHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+def test_slow_request_log_keeps_slowest():
+    """测试慢请求记录只保留耗时最长的N个"""
+    log = SlowRequestLog(capacity=2)
+    for total in (5, 30, 10, 20):
+        log.record({"total_ms": total})
+    assert [entry["total_ms"] for entry in log.snapshot()] == [30, 20]
+
+    log.clear()
+    assert log.snapshot() == []
+
+def test_request_timings_splits_upstream():
+    """测试上游耗时拆分为连接与等待两部分"""
+    timings = RequestTimings("/api/workflow/execute")
+    timings.add("upstream", 0.5)
+    timings.add("upstream_connect", 0.1)
+    entry = timings.finish(200)
+    assert entry["status_code"] == 200
+    assert entry["phases_ms"] == {"upstream_connect": 100.0, "upstream_wait": 400.0}
+
+def test_format_collapsed():
+    """测试折叠栈输出格式"""
+    stacks = Counter({"MainThread;main (a.py:1)": 3, "MainThread;main (a.py:1);run (b.py:5)": 7})
+    assert format_collapsed(stacks) == (
+        "MainThread;main (a.py:1);run (b.py:5) 7\n"
+        "MainThread;main (a.py:1) 3\n"
+    )
+
+@pytest.fixture
+def local_http_server():
+    server = HTTPServer(("127.0.0.1", 0), _OkHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def restore_connect():
+    originals = {cls: cls.__dict__["connect"] for cls in (connection.HTTPConnection, connection.HTTPSConnection)}
+    yield
+    for cls, connect in originals.items():
+        cls.connect = connect
+
+def test_connect_timer_records_upstream_connect(local_http_server, restore_connect):
+    """测试连接计时钩子记录真实请求的连接耗时，且重复安装不会重复包装"""
+    install_connect_timer()
+    wrapped = {cls: cls.__dict__.get("connect") for cls in (connection.HTTPConnection, connection.HTTPSConnection)}
+    install_connect_timer()
+    for cls, connect in wrapped.items():
+        assert cls.__dict__.get("connect") is connect
+        if connect is not None:
+            assert getattr(connect, "_profiling_wrapped", False)
+            assert not getattr(connect.__wrapped__, "_profiling_wrapped", False)
+
+    timings = RequestTimings("/api/workflow/execute")
+    token = current_timings.set(timings)
+    try:
+        with timings.phase("upstream"):
+            response = requests.get(local_http_server, timeout=5)
+        assert response.status_code == 200
+    finally:
+        current_timings.reset(token)
+
+    assert timings.phases["upstream_connect"] > 0
+    assert timings.phases["upstream_connect"] <= timings.phases["upstream"]
+    assert not timings.connecting
+
+def test_loop_lag_monitor_detects_blocking():
+    """测试事件循环被同步调用阻塞时能检测到延迟"""
+    async def run():
+        monitor = LoopLagMonitor(interval=0.01)
+        assert monitor.current_lag() is None
+        monitor.start()
+        await asyncio.sleep(0.03)
+        time.sleep(0.2)
+        # 阻塞刚结束、监控任务尚未醒来时即可估计出延迟
+        blocked_lag = monitor.current_lag()
+        await asyncio.sleep(0.03)
+        await monitor.stop()
+        return blocked_lag, monitor
+
+    blocked_lag, monitor = asyncio.run(run())
+    assert blocked_lag >= 0.15
+    assert monitor.max_lag >= 0.15
+    assert not monitor.running
+    monitor.reset()
+    assert monitor.stats()["max_lag_ms"] == 0